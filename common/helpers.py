@@ -1,6 +1,7 @@
-import io
 import os
-from PIL import Image as PILImage
+import tempfile
+import webbrowser
+from pathlib import Path
 
 from langchain_groq import ChatGroq
 from dotenv import load_dotenv
@@ -15,8 +16,10 @@ summarization_model = ChatGroq(model="llama-3.1-8b-instant", api_key=api_key2)
 
 
 def visualize_graph(graph: CompiledStateGraph):
-    bytes = graph.get_graph().draw_mermaid_png(max_retries=5, retry_delay=2.0)
-    img_stream = io.BytesIO(bytes)
+    png = graph.get_graph().draw_mermaid_png(max_retries=5, retry_delay=2.0)
 
-    img = PILImage.open(img_stream)
-    img.show()
\ No newline at end of file
+    # the png is handed to the default viewer as is, no decode/re-encode round trip through PIL
+    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
+        f.write(png)
+    # as_uri builds a valid file:///C:/... uri on windows, unlike prefixing the path with file://
+    webbrowser.open(Path(f.name).as_uri())
\ No newline at end of file
@@ -1,5 +1,9 @@
 # logger_config.py
 import logging
+import os
+
+# e.g. LOG_LEVEL=INFO in production so guarded debug output is never formatted
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
 
 class NewlineFormatter(logging.Formatter):
     def format(self, record):
@@ -14,7 +18,7 @@ def get_logger(name: str) -> logging.Logger:
     handler.setFormatter(formatter)
 
     logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(LOG_LEVEL)
     if not logger.hasHandlers():
         logger.addHandler(handler)
     return logger
\ No newline at end of file
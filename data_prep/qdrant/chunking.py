@@ -1,3 +1,4 @@
+import hashlib
 import json
 import time
 import uuid
@@ -19,6 +20,29 @@ batch_size = 100
 logger = get_logger(__name__)
 
 
+def drop_duplicate_documents(documents, ids, metadata):
+    """Drop chunks whose text was already seen, keeping the first one's id and metadata, so they are embedded once"""
+    seen = set()
+    kept = []
+    for index, document in enumerate(documents):
+        digest = hashlib.blake2b(document.encode(), digest_size=16).digest()
+        if digest not in seen:
+            seen.add(digest)
+            kept.append(index)
+
+    logger.debug(f"Dropped {len(documents) - len(kept)} duplicate chunks")
+    return [documents[i] for i in kept], [ids[i] for i in kept], [metadata[i] for i in kept]
+
+
+def _dedupe_and_embed(embed_fn, documents, ids, metadata):
+    """
+    Drops duplicate chunks and embeds the rest in one encode call, the model sorts them by length so batches
+    carry little padding. Returns the kept documents, ids and metadata with their embeddings.
+    """
+    documents, ids, metadata = drop_duplicate_documents(documents, ids, metadata)
+    return documents, ids, metadata, embed_fn(documents)
+
+
 def general_data_chunk(
         collection_name=q_a_collection_name,
         input_file_path=general_data_input_file
@@ -43,6 +67,8 @@ def general_data_chunk(
         ids.append(str(uuid.uuid4()))
         metadata.append({"record_id": idx, "source": "aou_rag_dataset", "qa_type": "qa_pair"})
 
+    documents, ids, metadata, all_embeddings = _dedupe_and_embed(embed_fn, documents, ids, metadata)
+
     # process by batches to avoid memory overload
     total_batches = range(0, len(documents), batch_size)
 
@@ -53,8 +79,7 @@ def general_data_chunk(
 
         logger.debug(f"Adding batch {i}–{i + batch_size} to collection")
 
-        # generate embeddings for batch
-        embeddings = embed_fn(batch_docs)
+        embeddings = all_embeddings[i:i + batch_size]
 
         # create points
         points = [
@@ -118,6 +143,8 @@ def pdf_markdown_json_chunking(
         for c in chunks
     ]
 
+    documents, ids, metadata, all_embeddings = _dedupe_and_embed(embed_fn, documents, ids, metadata)
+
     # Add by batches
     total_batches = range(0, len(documents), batch_size)
     for i in tqdm(total_batches, desc="Ingesting Markdown chunks", unit="batch"):
@@ -125,8 +152,7 @@ def pdf_markdown_json_chunking(
         batch_ids = ids[i:i + batch_size]
         batch_metadata = metadata[i:i + batch_size]
 
-        # Generate embeddings for batch
-        embeddings = embed_fn(batch_docs)
+        embeddings = all_embeddings[i:i + batch_size]
 
         # Create points
         points = [
@@ -438,6 +464,8 @@ def embed_csv_chunks(
     ids = [chunk["id"] for chunk in all_chunks]
     metadata = [chunk["metadata"] for chunk in all_chunks]
 
+    documents, ids, metadata, all_embeddings = _dedupe_and_embed(embed_fn, documents, ids, metadata)
+
     # Process in batches
     total_batches = range(0, len(documents), batch_size)
     for i in tqdm(total_batches, desc=f"Ingesting {collection_name}", unit="batch"):
@@ -445,8 +473,7 @@ def embed_csv_chunks(
         batch_ids = ids[i:i + batch_size]
         batch_metadata = metadata[i:i + batch_size]
 
-        # Generate embeddings
-        embeddings = embed_fn(batch_docs)
+        embeddings = all_embeddings[i:i + batch_size]
 
         # Create Qdrant points
         points = [
@@ -1,12 +1,18 @@
+import asyncio
+import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
+import numpy as np
 from dotenv import load_dotenv
 from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams
+from qdrant_client.models import Distance, VectorParams, ScalarQuantization, ScalarQuantizationConfig, ScalarType, \
+    BinaryQuantization, BinaryQuantizationConfig, SearchParams, QuantizationSearchParams
 
 from common import *
 from common.logger_config import get_logger
-from data_prep.qdrant import get_embedding_model
+from data_prep.qdrant import get_embedding_model, get_reranker_model
 
 logger = get_logger("QUADRANT_CONFIG")
 load_dotenv()
@@ -55,12 +61,44 @@ def get_qdrant_client():
     return _qdrant_client
 
 
+# texts per forward pass for embedding and reranking, all inputs are sent in one call and split by the model
+encode_batch_size = 64
+
+
 def get_embedding_function():
     """
     Get embedding function that returns a list of embeddings.
     """
     model = get_embedding_model()
-    return lambda texts: model.encode(texts, convert_to_numpy=True).tolist()
+    return lambda texts: model.encode(texts, batch_size=encode_batch_size, convert_to_numpy=True).tolist()
+
+
+@lru_cache(maxsize=4096)
+def embed_query(query_text):
+    """
+    Embed a single query, memoized so repeated queries skip the model.
+    Cached as a read-only float32 array (~1.5 KB for 384 dims, a tuple of floats takes ~12 KB), callers share it
+    as is so it must not be modified in place.
+    """
+    vector = get_embedding_model().encode(query_text, convert_to_numpy=True).astype(np.float32, copy=False)
+    vector.flags.writeable = False
+    return vector
+
+
+# int8 copies of the vectors kept in RAM for the HNSW search, 4x smaller than float32; qdrant rescores the top hits
+# with the original vectors so ranking quality is kept
+scalar_quantization = ScalarQuantization(
+    scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+)
+# 1 bit per dimension (32x smaller, hamming distance candidates), loses more recall on 384-d vectors so it needs
+# oversampled candidates rescored with the float vectors
+binary_quantization = BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+# "scalar" or "binary", applies to collections created or quantized from now on
+QUANTIZATION_MODE = os.getenv("QDRANT_QUANTIZATION", "scalar")
+quantization_config = binary_quantization if QUANTIZATION_MODE == "binary" else scalar_quantization
+search_params = SearchParams(
+    quantization=QuantizationSearchParams(rescore=True, oversampling=4.0)
+) if QUANTIZATION_MODE == "binary" else None
 
 
 def ensure_collection(collection_name):
@@ -81,12 +119,20 @@ def ensure_collection(collection_name):
                 size=vector_size,
                 distance=Distance.COSINE,
             ),
+            quantization_config=quantization_config,
         )
         print(f"Created collection '{collection_name}' in {'local' if is_local_qdrant() else 'cloud'} Qdrant")
 
     return client
 
 
+def quantize_collection(collection_name):
+    """Enable the configured quantization on a collection created before it was part of ensure_collection"""
+    client = get_qdrant_client()
+    client.update_collection(collection_name=collection_name, quantization_config=quantization_config)
+    logger.debug(f"Enabled {QUANTIZATION_MODE} quantization on '{collection_name}'")
+
+
 def get_q_a_collection():
     """Get Q&A collection client"""
     return ensure_collection(q_a_collection_name)
@@ -102,26 +148,96 @@ def get_csv_collection(collection_name):
     return ensure_collection(collection_name)
 
 
+# collections searched for every user query
+searchable_collections = [tutors_collection_name, modules_collection_name, q_a_collection_name]
+
+
+def _search_collection(client, collection_name, query_vector, n_results):
+    """Search a single collection and return the stored documents"""
+    search_results = client.search(
+        collection_name=collection_name,
+        query_vector=query_vector,
+        limit=n_results,
+        search_params=search_params,
+    )
+    return [hit.payload.get("document", "") for hit in search_results]
+
+
+def dedupe_documents(documents):
+    """
+    Keep the first occurrence of each document, ignoring case and whitespace differences.
+    Chunks stored in more than one collection would otherwise be scored and sent to the llm twice.
+    """
+    seen = set()
+    unique = []
+    for document in documents:
+        key = hashlib.blake2b(" ".join(document.lower().split()).encode(), digest_size=8).digest()
+        if key not in seen:
+            seen.add(key)
+            unique.append(document)
+    return unique
+
+
 def query_all_collections(query_text, n_results=5):
     """Query both Q&A and PDF collections"""
     client = get_qdrant_client()
-    embed_fn = get_embedding_function()
 
     # Generate query embedding
-    query_vector = embed_fn([query_text])[0]
+    query_vector = embed_query(query_text)
+
+    # the collections are searched in parallel with the same vector, wall time is one round trip instead of one per collection
+    with ThreadPoolExecutor(max_workers=len(searchable_collections)) as executor:
+        searches = executor.map(
+            lambda collection_name: _search_collection(client, collection_name, query_vector, n_results),
+            searchable_collections
+        )
+        results = [document for documents in searches for document in documents]
+
+    return dedupe_documents(results)
+
+
+# cross-encoder logits below this are treated as unrelated to the query
+rerank_min_score = -5.0
 
-    results = []
-    collections = [tutors_collection_name, modules_collection_name, q_a_collection_name]
-    for collection_name in collections:
-            search_results = client.search(
-                collection_name=collection_name,
-                query_vector=query_vector,
-                limit=n_results,
-            )
-            documents = [hit.payload.get("document", "") for hit in search_results]
-            results.extend(documents)
 
-    return results
+def rerank_documents(query_text, documents, top_k=5, min_score=rerank_min_score):
+    """Score documents against the query with the local cross-encoder and keep the best top_k above min_score"""
+    if not documents:
+        return []
+
+    # every pair is scored in a single batched call rather than one forward pass per document
+    scores = get_reranker_model().predict(
+        [(query_text, document) for document in documents],
+        batch_size=encode_batch_size
+    )
+    ranked = sorted(zip(scores, documents), key=lambda pair: pair[0], reverse=True)
+    return [document for score, document in ranked[:top_k] if score >= min_score]
+
+
+async def aquery_all_collections(query_text, n_results=5):
+    """Async variant of query_all_collections that searches every collection concurrently"""
+    client = get_qdrant_client()
+
+    # embed once and share the vector across all collection searches
+    query_vector = await asyncio.to_thread(embed_query, query_text)
+
+    searches = await asyncio.gather(
+        *(
+            asyncio.to_thread(_search_collection, client, collection_name, query_vector, n_results)
+            for collection_name in searchable_collections
+        ),
+        return_exceptions=True
+    )
+
+    results = []
+    for collection_name, documents in zip(searchable_collections, searches):
+        # one unreachable collection should not drop the results of the others
+        if isinstance(documents, Exception):
+            logger.warning(f"Could not query collection '{collection_name}': {documents}")
+            continue
+        results.extend(documents)
+
+    return dedupe_documents(results)
 
 
 if __name__ == '__main__':
@@ -9,6 +9,27 @@ import tiktoken
 import unicodedata
 from tqdm import tqdm
 
+# markdown patterns compiled once, normalize_markdown/segment_markdown_sections run them over every file
+HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+CODE_BLOCK_PATTERN = re.compile(r'```(.*?)```', re.DOTALL)
+CODE_FENCE_PATTERN = re.compile(r'```[a-zA-Z]*\n')
+HEADER_PATTERN = re.compile(r'^(#{1,6})\s*(.*)$', re.MULTILINE)
+BOLD_PATTERN = re.compile(r'(\*\*|__)(.*?)\1')
+ITALIC_PATTERN = re.compile(r'(\*|_)(.*?)\1')
+STRIKETHROUGH_PATTERN = re.compile(r'~~(.*?)~~')
+BULLET_PATTERN = re.compile(r'^\s*[-*+]\s+', re.MULTILINE)
+NUMBERED_PATTERN = re.compile(r'^\s*\d+\.\s+', re.MULTILINE)
+BLOCKQUOTE_PATTERN = re.compile(r'^\s*>\s?', re.MULTILINE)
+IMAGE_PATTERN = re.compile(r'!\[([^\]]*)\]\(([^)]+)\)')
+LINK_PATTERN = re.compile(r'\[([^\]]+)\]\(([^)]+)\)')
+INLINE_CODE_PATTERN = re.compile(r'`([^`]*)`')
+SPACES_PATTERN = re.compile(r'[ \t]+')
+BLANK_LINES_PATTERN = re.compile(r'\n{3,}')
+SECTION_HEADER_PATTERN = re.compile(r'^(#{1,6})\s+(.*)$', re.MULTILINE)
+
+# same tokenizer used in OpenAI models, loaded once for every section
+tokenizer = tiktoken.get_encoding("cl100k_base")
+
 
 def clean_text(text: str) -> str:
     if not isinstance(text, str):
@@ -149,20 +170,20 @@ def normalize_markdown(md_text: str, keep_code_blocks: bool = False) -> Dict[str
     # ----------------------------
     # 2. Remove HTML tags (if markdown was generated from HTML)
     # ----------------------------
-    text = re.sub(r'<[^>]+>', '', text)
+    text = HTML_TAG_PATTERN.sub('', text)
 
     # ----------------------------
     # 3. Handle code blocks
     # ----------------------------
-    code_blocks = re.findall(r'```(.*?)```', text, re.DOTALL)
+    code_blocks = CODE_BLOCK_PATTERN.findall(text)
     code_block_count = len(code_blocks)
 
     if not keep_code_blocks:
         # Replace code blocks entirely with a placeholder (helps preserve context)
-        text = re.sub(r'```.*?```', '[CODE BLOCK]', text, flags=re.DOTALL)
+        text = CODE_BLOCK_PATTERN.sub('[CODE BLOCK]', text)
     else:
         # Or normalize inline (remove ```lang and keep code content)
-        text = re.sub(r'```[a-zA-Z]*\n', '', text)
+        text = CODE_FENCE_PATTERN.sub('', text)
         text = text.replace('```', '\n')
 
     # ----------------------------
@@ -174,48 +195,46 @@ def normalize_markdown(md_text: str, keep_code_blocks: bool = False) -> Dict[str
         level = len(hashes)
         return f"\n{'#' * level} {header_text.upper()}\n"
 
-    text = re.sub(r'^(#{1,6})\s*(.*)$', header_replacer, text, flags=re.MULTILINE)
+    text = HEADER_PATTERN.sub(header_replacer, text)
 
     # ----------------------------
     # 5. Normalize bold, italic, and strikethrough
     # ----------------------------
     # bold (**text** or __text__)
-    text = re.sub(r'(\*\*|__)(.*?)\1', r'\2', text)
+    text = BOLD_PATTERN.sub(r'\2', text)
     # italic (*text* or _text_)
-    text = re.sub(r'(\*|_)(.*?)\1', r'\2', text)
+    text = ITALIC_PATTERN.sub(r'\2', text)
     # strikethrough (~~text~~)
-    text = re.sub(r'~~(.*?)~~', r'\1', text)
+    text = STRIKETHROUGH_PATTERN.sub(r'\1', text)
 
     # ----------------------------
     # 6. Normalize lists and blockquotes
     # ----------------------------
     # lists (-, *, +, or numbered)
-    text = re.sub(r'^\s*[-*+]\s+', '• ', text, flags=re.MULTILINE)
-    text = re.sub(r'^\s*\d+\.\s+', '• ', text, flags=re.MULTILINE)
+    text = BULLET_PATTERN.sub('• ', text)
+    text = NUMBERED_PATTERN.sub('• ', text)
     # blockquotes (> ...)
-    text = re.sub(r'^\s*>\s?', '', text, flags=re.MULTILINE)
+    text = BLOCKQUOTE_PATTERN.sub('', text)
 
     # ----------------------------
     # 7. Normalize links and images
     # ----------------------------
     # images ![alt](url)
-    image_count = len(re.findall(r'!\[([^\]]*)\]\(([^)]+)\)', text))
-    text = re.sub(r'!\[([^\]]*)\]\(([^)]+)\)', r'\1', text)
+    text, image_count = IMAGE_PATTERN.subn(r'\1', text)
 
     # links [text](url) → text (url)
-    link_count = len(re.findall(r'\[([^\]]+)\]\(([^)]+)\)', text))
-    text = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', r'\1 (\2)', text)
+    text, link_count = LINK_PATTERN.subn(r'\1 (\2)', text)
 
     # ----------------------------
     # 8. Remove residual markdown characters (like inline code `code`)
     # ----------------------------
-    text = re.sub(r'`([^`]*)`', r'\1', text)
+    text = INLINE_CODE_PATTERN.sub(r'\1', text)
 
     # ----------------------------
     # 9. Cleanup whitespace
     # ----------------------------
-    text = re.sub(r'[ \t]+', ' ', text)
-    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = SPACES_PATTERN.sub(' ', text)
+    text = BLANK_LINES_PATTERN.sub('\n\n', text)
     text = text.strip()
 
     # ----------------------------
@@ -243,8 +262,7 @@ def chunk_section_text(section: Dict[str, str], max_tokens: int = 500, overlap:
         List of chunk dicts, each containing title, chunk_id, and content.
     """
 
-    enc = tiktoken.get_encoding("cl100k_base")  # same tokenizer used in OpenAI models
-    tokens = enc.encode(section["content"])
+    tokens = tokenizer.encode(section["content"])
     total_tokens = len(tokens)
 
     chunks = []
@@ -254,7 +272,7 @@ def chunk_section_text(section: Dict[str, str], max_tokens: int = 500, overlap:
     while start < total_tokens:
         end = start + max_tokens
         chunk_tokens = tokens[start:end]
-        chunk_text = enc.decode(chunk_tokens)
+        chunk_text = tokenizer.decode(chunk_tokens)
 
         chunk = {
             "title": section["title"],
@@ -286,8 +304,7 @@ def segment_markdown_sections(normalized_text: str) -> List[Dict[str, str]]:
     # ----------------------------
     # 1. Split by headers (capture headers too)
     # ----------------------------
-    pattern = r'^(#{1,6})\s+(.*)$'
-    matches = list(re.finditer(pattern, normalized_text, flags=re.MULTILINE))
+    matches = list(SECTION_HEADER_PATTERN.finditer(normalized_text))
 
     sections = []
 
@@ -352,11 +369,12 @@ def process_markdown_folder(folder_path, output_path, max_tokens=500, overlap=50
     """
     all_docs = []
 
-    for filename in tqdm(os.listdir(folder_path), desc="Processing md files for chunking"):
-        if not filename.endswith(".md"):
-            continue
+    # scandir entries carry their name, path and file type, so no path joins or extra stat calls per file
+    with os.scandir(folder_path) as entries:
+        md_entries = [entry for entry in entries if entry.name.endswith(".md") and entry.is_file()]
 
-        file_path = os.path.join(folder_path, filename)
+    for entry in tqdm(md_entries, desc="Processing md files for chunking"):
+        filename, file_path = entry.name, entry.path
 
         # 1. Read & clean
         text = read_text_file(file_path)
@@ -0,0 +1,22 @@
+-- Applies a batch of query_logs updates in one call and one transaction, used by QueryLogger when QUERY_LOG_BATCH_RPC=1.
+-- Each element of payloads is {"id": ..., <any of the other columns>}, columns missing from an element keep their value.
+create or replace function log_batch(payloads jsonb)
+returns void
+language sql
+as $$
+    update query_logs as q
+    set query_text    = coalesce(p.query_text, q.query_text),
+        ip_address    = coalesce(p.ip_address, q.ip_address),
+        user_agent    = coalesce(p.user_agent, q.user_agent),
+        error_message = coalesce(p.error_message, q.error_message),
+        response      = coalesce(p.response, q.response)
+    from jsonb_to_recordset(payloads) as p(
+        id bigint,
+        query_text text,
+        ip_address text,
+        user_agent text,
+        error_message text,
+        response text
+    )
+    where q.id = p.id;
+$$;
@@ -0,0 +1,92 @@
+import asyncio
+import os
+import sqlite3
+from typing import Any, AsyncIterator, Optional, Sequence
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+CHECKPOINT_DB_PATH = os.getenv("CHECKPOINT_DB_PATH", ".lg_checkpoints.db")
+# checkpoints kept per thread, older ones (and their pending writes) are pruned on every put
+CHECKPOINTS_PER_THREAD = int(os.getenv("CHECKPOINTS_PER_THREAD", "10"))
+
+_PRUNE_TABLES = ("checkpoints", "writes")
+
+
+class ThreadedSqliteSaver(SqliteSaver):
+    """
+    SqliteSaver whose async methods run the sync ones in a worker thread.
+    AsyncSqliteSaver is bound to the event loop it was created on, while Streamlit drives every streamed answer
+    on a fresh loop, so the sync saver (already guarded by its own lock) is shared across both APIs instead.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, max_checkpoints: int = CHECKPOINTS_PER_THREAD):
+        super().__init__(conn)
+        self.max_checkpoints = max_checkpoints
+
+    def put(
+            self,
+            config: RunnableConfig,
+            checkpoint: Checkpoint,
+            metadata: CheckpointMetadata,
+            new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        next_config = super().put(config, checkpoint, metadata, new_versions)
+        self._prune(next_config["configurable"]["thread_id"], next_config["configurable"]["checkpoint_ns"])
+        return next_config
+
+    def _prune(self, thread_id: str, checkpoint_ns: str) -> None:
+        """Keeps only the newest checkpoints of a thread so the database stays O(recent turns)"""
+        # checkpoint ids are time-ordered, the saver itself sorts on them to find the latest one
+        with self.cursor() as cur:
+            for table in _PRUNE_TABLES:
+                cur.execute(
+                    f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN ("
+                    "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                    "ORDER BY checkpoint_id DESC LIMIT ?)",
+                    (thread_id, checkpoint_ns, thread_id, checkpoint_ns, self.max_checkpoints),
+                )
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+            self,
+            config: Optional[RunnableConfig],
+            *,
+            filter: Optional[dict[str, Any]] = None,
+            before: Optional[RunnableConfig] = None,
+            limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        checkpoints = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for checkpoint in checkpoints:
+            yield checkpoint
+
+    async def aput(
+            self,
+            config: RunnableConfig,
+            checkpoint: Checkpoint,
+            metadata: CheckpointMetadata,
+            new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+            self,
+            config: RunnableConfig,
+            writes: Sequence[tuple[str, Any]],
+            task_id: str,
+            task_path: str = "",
+    ) -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+
+def get_checkpointer(path: str = CHECKPOINT_DB_PATH) -> ThreadedSqliteSaver:
+    """Opens the on-disk checkpointer, the connection is shared across threads and serialized by the saver's lock"""
+    return ThreadedSqliteSaver(sqlite3.connect(path, check_same_thread=False))
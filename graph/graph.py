@@ -1,17 +1,25 @@
+import asyncio
+import hashlib
+import logging
+import re
 import sys
-from copy import copy
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 
 from langchain.agents import create_agent
 from langchain.agents.middleware import SummarizationMiddleware
+from langchain_community.cache import SQLiteCache
+from langchain_core.globals import set_llm_cache
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage, RemoveMessage
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.constants import START, END
 from langgraph.graph import StateGraph, MessagesState
 from langgraph.graph.state import CompiledStateGraph
 from langgraph.types import Command
 
 from common.helpers import llm, summarization_model
-from common.pretty_print import pretty_print_messages
+from common.logger_config import get_logger
+from data_prep.qdrant.config import aquery_all_collections, rerank_documents
 
 
 def is_streamlit():
@@ -20,14 +28,20 @@ def is_streamlit():
 
 
 if is_streamlit():
-    from graph.prompt import AOU_NET_SYSTEM_PROMPT, RERANK_PROMPT, AGENT_ROUTER_PROMPT
+    from graph.prompt import AOU_NET_SYSTEM_PROMPT, AGENT_ROUTER_PROMPT, render_rerank_prompt
     from graph.schema import AgentState, AgentRouterSchema, RetrieveMessageReranked
+    from graph.semantic_cache import SemanticCache, embed_text
+    from graph.checkpointer import get_checkpointer
     from graph.tools import *
 else:
-    from prompt import AOU_NET_SYSTEM_PROMPT, RERANK_PROMPT
+    from prompt import AOU_NET_SYSTEM_PROMPT, AGENT_ROUTER_PROMPT, render_rerank_prompt
     from schema import AgentState, AgentRouterSchema, RetrieveMessageReranked
+    from semantic_cache import SemanticCache, embed_text
+    from checkpointer import get_checkpointer
     from tools import *
 
+logger = get_logger(__name__)
+
 # todo: fix conversation dataset format user/assistant, might confuse llm
 # todo: add debugging prints or loggers for each step to monitor state change and stateless llm calls
 # todo: implement reranker top-k
@@ -39,17 +53,31 @@ else:
 
 
 tools = [searching_aou_site, retrieve_aou_knowledge_base]
+# case-insensitive name lookup built once instead of scanning tools per call
+TOOLS_BY_NAME = {t.name.lower(): t for t in tools}
+# tools whose output goes through the reranker, a set lookup instead of building a list per call
+RERANKED_TOOLS = frozenset({searching_aou_site.name, retrieve_aou_knowledge_base.name})
 llm_with_tools = llm.bind_tools(tools)
 llm_with_agent_router = llm.with_structured_output(AgentRouterSchema, method="json_schema")
 llm_with_reranker = llm.with_structured_output(RetrieveMessageReranked, method="json_schema")
 
+# exact prompt cache shared by every llm call, plus a semantic QA cache for paraphrased questions
+set_llm_cache(SQLiteCache(database_path=".llm_cache.db"))
+# answers can come from live web search, so like retrieval_cache they expire after ten minutes
+response_cache = SemanticCache(threshold=0.95, ttl_seconds=600)
+# router decisions are a tiny enum, so near duplicate queries can safely reuse them, exact repeats hit the
+# memoized query embedding and cost only a dot product
+router_cache = SemanticCache(threshold=0.97, max_size=10_000)
+# built once, call_llm prepends the same message instead of validating a new one per call
+SYSTEM_MESSAGE = SystemMessage(content=AOU_NET_SYSTEM_PROMPT)
+
 
 # ============================================================================
 # NODE FUNCTIONS
 # ============================================================================
 
 # not using it anymore, might remove later
-def retrieval(state: AgentState) -> Dict[str, Any]:
+async def retrieval(state: AgentState) -> Dict[str, Any]:
     """
     Retrieves relevant documents from collections based on the user's query.
 
@@ -57,7 +85,7 @@ def retrieval(state: AgentState) -> Dict[str, Any]:
         state: Current agent state containing messages
 
     Returns:
-        Dict with retrieval_result, query, and messages
+        Dict with retrieval_result, query, and messages (only query when the results are reused)
     """
     # extract query from the last human message
     last_message = state["messages"][-1]
@@ -75,14 +103,21 @@ def retrieval(state: AgentState) -> Dict[str, Any]:
             "messages": state['messages']
         }
 
+    # same query as the one already retrieved for, e.g. when the tool loop re-enters this node, reuse the results;
+    # retrieval_result is an accumulating channel so it is left out of the update rather than re-sent
+    if query == state.get('query') and state.get('retrieval_result'):
+        return {"query": query}
+
     results = []
 
     try:
-        results = query_all_collections(query)
+        results = await aquery_all_collections(query)
+        results = await asyncio.to_thread(rerank_documents, query, results)
         # for debugging
-        print(f"collections result: {results}", file=sys.stderr, flush=True)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("collections result: %r", results)
     except Exception as e:
-        print(f"Error querying collection: {e}")
+        logger.error("Error querying collection: %s", e)
 
     return {
         "retrieval_result": results,
@@ -91,14 +126,24 @@ def retrieval(state: AgentState) -> Dict[str, Any]:
     }
 
 
-def router(state: AgentState) -> Command[Literal["sql_subgraph", "call_llm"]]:
+async def router(state: AgentState) -> Command[Literal["sql_subgraph", "call_llm"]]:
     message = state["messages"][-1]
-    res = llm_with_agent_router.invoke(
-        [
-            {"role": "system", "content": AGENT_ROUTER_PROMPT},
-            {"role": "user", "content": message},
-        ]
-    )
+
+    res = None
+    query_vector = None
+    if isinstance(message.content, str) and message.content.strip():
+        query_vector = await asyncio.to_thread(embed_text, message.content.strip().lower())
+        res = router_cache.get(query_vector)
+
+    if res is None:
+        res = await llm_with_agent_router.ainvoke(
+            [
+                {"role": "system", "content": AGENT_ROUTER_PROMPT},
+                {"role": "user", "content": message.content},
+            ]
+        )
+        if query_vector is not None:
+            router_cache.put(query_vector, res)
     update = AIMessage(res.reasoning)
 
     if res.classification == "tutors_modules":
@@ -109,137 +154,205 @@ def router(state: AgentState) -> Command[Literal["sql_subgraph", "call_llm"]]:
         raise ValueError(f"Invalid classification {res.classification}")
     return Command(goto=goto, update=update)
 
-def add_system_message_if_needed(state: MessagesState) -> dict:
-    """Add system message only if this is the first message in the conversation."""
 
-    # check if we already have a system message
-    has_system_message = any(isinstance(msg, SystemMessage) for msg in state['messages'])
+# reranked tool output keyed by a digest of (query, data), retries and repeated tool calls skip the reranker llm
+RERANK_CACHE_SIZE = 512
+_rerank_cache: OrderedDict[str, RetrieveMessageReranked] = OrderedDict()
+# streamlit sessions run on their own threads, the lookup and the eviction must not interleave
+_rerank_cache_lock = threading.Lock()
+# tool output shorter than this has too little to trim for a reranker call to pay off; gated on length only since
+# web search results arrive as a single-line str() of a list of dicts
+RERANK_MIN_CHARS = 600
 
-    if not has_system_message:
-        system_message = SystemMessage(AOU_NET_SYSTEM_PROMPT)
-        # getting user message
-        user_message = state["messages"][0]
-        # preparing to remove user message from state
-        to_remove = [RemoveMessage(user_message.id)]
-        # making a copy of the user message and changing its id to not interfer wiht deletion
-        to_add_user_message = copy(user_message)
-        to_add_user_message.id = user_message.id + "first"
-        # adding system first then user message
-        to_add = [system_message, to_add_user_message]
-        return {"messages": to_remove + to_add}
 
-    return {"messages": []}
+async def rerank_and_optimize_retrieved(query: str, data: str) -> RetrieveMessageReranked | str:
+    if len(data) < RERANK_MIN_CHARS:
+        return data
 
+    key = hashlib.blake2b(f"{query}\x1f{data}".encode(), digest_size=16).hexdigest()
+    with _rerank_cache_lock:
+        cached = _rerank_cache.get(key)
+        if cached is not None:
+            _rerank_cache.move_to_end(key)
+            return cached
 
-def rerank_and_optimize_retrieved(query: str, data: str) -> RetrieveMessageReranked | str:
     try:
-        return llm_with_reranker.invoke(RERANK_PROMPT.substitute(query=query, retrieved_data=data))
+        reranked = await llm_with_reranker.ainvoke(render_rerank_prompt(query, data))
     except Exception as e:
-        print("Could not call reranker")
+        # failures are not cached so the next call retries the reranker
+        logger.warning("Could not call reranker: %s", e)
         return data
 
+    with _rerank_cache_lock:
+        _rerank_cache[key] = reranked
+        if len(_rerank_cache) > RERANK_CACHE_SIZE:
+            _rerank_cache.popitem(last=False)
+    return reranked
+
+
+# messages before the current question that must match for a cached answer to be reused
+CONTEXT_TAIL_SIZE = 2
+
+
+def _context_digest(messages: list, question_index: int) -> str:
+    """Short digest of the exchange right before the question, an opening question gets the empty digest"""
+    tail = messages[max(0, question_index - CONTEXT_TAIL_SIZE):question_index]
+    if not tail:
+        return ""
+    return hashlib.blake2b("\x1f".join(str(msg.content) for msg in tail).encode(), digest_size=8).hexdigest()
+
 
-def call_llm(state: AgentState) -> Dict[str, Any]:
-    response = llm_with_tools.invoke(state['messages'])
+def _current_question(messages: list) -> tuple[str | None, str]:
+    """Returns the text of the current turn's question together with the digest of the exchange before it"""
+    for index in range(len(messages) - 1, -1, -1):
+        # the type tag is a plain string compare, cheaper than an isinstance walk over the message class hierarchy
+        if messages[index].type == "human":
+            if not isinstance(messages[index].content, str):
+                return None, ""
+            return messages[index].content, _context_digest(messages, index)
+    return None, ""
+
+
+# bare greetings/thanks/goodbyes get a canned reply, the group that matched picks it
+SMALL_TALK_PATTERN = re.compile(
+    r"\s*(?:(?P<greeting>hi|hello|hey)|(?P<thanks>thanks?|thank you)|(?P<bye>bye|goodbye))[\s.!]*",
+    re.IGNORECASE,
+)
+SMALL_TALK_REPLIES = {
+    "greeting": "Hello! How can I help you with AOU today?",
+    "thanks": "You're welcome! Let me know if you have any other questions about AOU.",
+    "bye": "Goodbye! Feel free to come back if you have more questions about AOU.",
+}
+
+
+async def qa_cache_lookup(state: AgentState) -> Command[Literal["call_llm", "cleanup_state", "__end__"]]:
+    """Answers small talk and repeated questions without the llm and tools"""
+    question, context_digest = _current_question(state['messages'])
+    if question:
+        small_talk = SMALL_TALK_PATTERN.fullmatch(question)
+        if small_talk:
+            # nothing to clean up or cache for a canned reply
+            return Command(goto=END, update={"messages": [AIMessage(SMALL_TALK_REPLIES[small_talk.lastgroup])]})
+
+        cached_answer = response_cache.get(await asyncio.to_thread(embed_text, question), scope=context_digest)
+        if cached_answer is not None:
+            return Command(goto="cleanup_state", update={"messages": [AIMessage(cached_answer)]})
+
+    return Command(goto="call_llm")
+
+
+async def call_llm(state: AgentState) -> Dict[str, Any]:
+    # ainvoke rather than astream so the exact SQLiteCache tier is checked and filled; astream bypasses the llm cache,
+    # and stream_mode="messages" consumers still receive tokens through langgraph's streaming callback
+    # the system prompt is prepended per call rather than stored, add_messages can only append so keeping it first
+    # in state meant deleting and re-adding the user's opening message
+    response = await llm_with_tools.ainvoke([SYSTEM_MESSAGE] + state['messages'])
 
     return {"messages": [response]}
 
 
-def tool_handler(state: dict):
-    "Performs tool call"
+async def _run_tool_call(tool_call: dict) -> ToolMessage:
+    """Runs a single tool call, reranking search/retrieval output, and wraps the outcome in a ToolMessage"""
+    # unpack once instead of indexing the tool call dict repeatedly
+    name, args, tool_call_id = tool_call['name'], tool_call['args'], tool_call['id']
+    try:
+        # get the tool
+        tool = TOOLS_BY_NAME.get(name.lower())
 
-    # list tool for tool message
-    result = []
-    # iterate through tool calls
-
-    for tool_call in state['messages'][-1].tool_calls:
-        try:
-            # get the tool
-            tool = next((t for t in tools if t.name.lower() == tool_call["name"].lower()), None)
-
-            if tool is None:
-                result.append(ToolMessage(
-                    content=f"Error: Tool '{tool_call['name']}' not found",
-                    tool_call_id=tool_call['id']
-                ))
-                continue
-
-            # run the tool
-            tool_res = tool.invoke(tool_call['args'])
-
-            # ensure content is a string
-            if not isinstance(tool_res, str):
-                tool_res = str(tool_res)
-
-            print(50 * "=", "before reranked\n", tool_res)
-            # format, rerank, optimize, and return top-k for tool result (search & retrieval only) to reduce token usage
-            # only for these two tools
-            if tool.name in [searching_aou_site.name, retrieve_aou_knowledge_base.name]:
-                reranked_info = rerank_and_optimize_retrieved(tool_call['args']['query'], tool_res)
-                print(50 * "=", "query is\n", tool_call['args']['query'])
-                # in case of error this will be a string returning the original data without reranking
-                if isinstance(reranked_info, RetrieveMessageReranked):
-                    tool_res = str(reranked_info.messages)
-                    print(50 * "=", "after reranked\n", tool_res)
-            # create a ToolMessage
-            result.append(
-                ToolMessage(
-                    content=tool_res,
-                    tool_call_id=tool_call['id']
-                )
-            )
-        except Exception as e:
-            result.extend(
-                [
-                    ToolMessage(
-                        content=f"Error executing tool '{tool_call['name']}': {str(e)}. Please try again with different parameters.",
-                        tool_call_id=tool_call['id']
-                    )
-                ]
+        if tool is None:
+            return ToolMessage(
+                content=f"Error: Tool '{name}' not found",
+                tool_call_id=tool_call_id
             )
 
+        # run the tool
+        tool_res = await tool.ainvoke(args)
+
+        # ensure content is a string
+        if not isinstance(tool_res, str):
+            tool_res = str(tool_res)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("tool=%s args=%r before reranked:\n%s", tool.name, args, tool_res)
+        # format, rerank, optimize, and return top-k for tool result (search & retrieval only) to reduce token usage
+        # only for these two tools
+        if tool.name in RERANKED_TOOLS:
+            reranked_info = await rerank_and_optimize_retrieved(args['query'], tool_res)
+            # in case of error this will be a string returning the original data without reranking
+            if isinstance(reranked_info, RetrieveMessageReranked):
+                tool_res = str(reranked_info.messages)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("tool=%s after reranked:\n%s", tool.name, tool_res)
+        # create a ToolMessage
+        return ToolMessage(
+            content=tool_res,
+            tool_call_id=tool_call_id
+        )
+    except Exception as e:
+        return ToolMessage(
+            content=f"Error executing tool '{name}': {str(e)}. Please try again with different parameters.",
+            tool_call_id=tool_call_id
+        )
+
+
+async def tool_handler(state: AgentState):
+    "Performs tool call"
+
+    # tool calls are independent, run them concurrently so the turn waits for the slowest instead of the sum,
+    # gather keeps the results in the same order as the calls
+    result = await asyncio.gather(*(_run_tool_call(tool_call) for tool_call in state['messages'][-1].tool_calls))
+
+    # tool messages are appended after the current history, record where they land
+    prev_len = len(state['messages'])
     return {
-        "messages": result
+        "messages": list(result),
+        "tool_msg_indices": list(range(prev_len, prev_len + len(result)))
     }
 
 
 def cleanup_state(state: AgentState) -> MessagesState:
     """Clean up temporary state after query completion, keep only conversation."""
 
-    # keep only user query and final AI response for conversation history
-    messages_to_keep = []
-
-    # find the last user message (current query)
-    last_human_msg = None
-    for msg in reversed(state['messages']):
-        if isinstance(msg, HumanMessage):
-            last_human_msg = msg
-            break
-
-    # find the final AI response (last AIMessage with content)
+    # single reverse pass over the current turn: the final AI response (last AIMessage with content) comes first,
+    # then the user question of this turn
+    messages = state['messages']
     final_ai_msg = None
-    for msg in reversed(state['messages']):
-        if isinstance(msg, AIMessage) and msg.content and msg.content.strip():
+    question_index = None
+    for index in range(len(messages) - 1, -1, -1):
+        msg = messages[index]
+        # type tags instead of isinstance, call_llm stores merged AIMessages (type "ai") rather than chunks
+        if msg.type == "human":
+            question_index = index
+            break
+        if final_ai_msg is None and msg.type == "ai" and msg.content and msg.content.strip():
             # Skip reasoning messages
             if not msg.content.startswith("reasoning:"):
                 final_ai_msg = msg
-                break
-
-    remove_message = None
-    for msg in reversed(state['messages']):
-        if isinstance(msg, ToolMessage):
-            # removing redundant tool result from chat history after the model has answered to reduce chat history size
-            remove_message = RemoveMessage(msg.id)
-            break
 
-    if last_human_msg:
-        messages_to_keep.append(last_human_msg)
-    if final_ai_msg:
-        messages_to_keep.append(final_ai_msg)
+    # keep only user query and final AI response for conversation history, the kept messages are already in state
+    # so only removals are returned and the checkpointer applies the diff instead of reconciling the whole history
+    messages_to_drop = []
+    tool_msg_indices = state.get('tool_msg_indices') or []
+    if tool_msg_indices:
+        # the ai message requesting the first tool sits right before its result, everything after it is tool work
+        for msg in messages[tool_msg_indices[0] - 1:]:
+            if msg is not final_ai_msg:
+                messages_to_drop.append(RemoveMessage(msg.id))
+
+    # remember the answer, scoped to the exchange it followed, unless a tool failed while producing it
+    tool_failed = any(messages[i].content.startswith("Error") for i in tool_msg_indices)
+    if question_index is not None and isinstance(messages[question_index].content, str) \
+            and final_ai_msg and not tool_failed:
+        question_vector = embed_text(messages[question_index].content)
+        context_digest = _context_digest(messages, question_index)
+        if response_cache.get(question_vector, scope=context_digest) is None:
+            response_cache.put(question_vector, final_ai_msg.content, scope=context_digest)
 
     return {
-        # to avoid "NotImplementedError: Unsupported message type: <class 'NoneType'>" if no tool was found
-        "messages": [remove_message] + messages_to_keep if remove_message else messages_to_keep
+        "messages": messages_to_drop,
+        # tool positions and retrieved chunks are only valid for the turn that produced them
+        "tool_msg_indices": None,
+        "retrieval_result": None
     }
 
 
@@ -261,12 +374,15 @@ def should_continue(state: AgentState) -> Literal["tool_handler", "cleanup_state
 # ============================================================================
 # CONSTRUCTING AOU MULTI-RETRIEVAL SUPGRAPH
 # ============================================================================
-memory = MemorySaver()
+# checkpoints live in sqlite instead of the process heap and survive restarts
+memory = get_checkpointer()
 
 
+@lru_cache(maxsize=1)
 def build_assistant() -> CompiledStateGraph[Any, Any, Any, Any]:
     """
-    Constructs the retrieval state graph that either gets data via RAG or via websearch
+    Constructs the retrieval state graph that either gets data via RAG or via websearch.
+    Compiled once per process, later calls share the same graph and checkpointer.
 
     Returns:
         Compiled StateGraph ready for execution
@@ -274,13 +390,13 @@ def build_assistant() -> CompiledStateGraph[Any, Any, Any, Any]:
     builder = StateGraph(AgentState)
 
     # nodes
-    builder.add_node("add_system_message", add_system_message_if_needed)
+    builder.add_node("qa_cache_lookup", qa_cache_lookup)
     builder.add_node("call_llm", call_llm)
     builder.add_node("tool_handler", tool_handler)
     builder.add_node("cleanup_state", cleanup_state)
     # flow
-    builder.add_edge(START, "add_system_message")
-    builder.add_edge("add_system_message", "call_llm")
+    # qa_cache_lookup routes itself to call_llm, to cleanup_state on a cache hit, or to END after small talk
+    builder.add_edge(START, "qa_cache_lookup")
 
     # Conditional edge: continue to tools or end
     builder.add_conditional_edges(
@@ -301,7 +417,9 @@ def build_assistant() -> CompiledStateGraph[Any, Any, Any, Any]:
 # ============================================================================
 # TEST
 # ============================================================================
+@lru_cache(maxsize=1)
 def get_agent():
+    """Builds the prebuilt tool calling agent once per process, every session reuses it through its thread_id"""
     return create_agent(
         model=llm,
         tools=tools,
@@ -317,7 +435,11 @@ def get_agent():
     )
 
 
-if __name__ == "__main__":
+# nodes whose chat model tokens are the answer shown to the user, for get_agent and build_assistant
+ANSWER_NODES = ("model", "call_llm")
+
+
+async def main():
     config = {"configurable": {"thread_id": "memory_test"}}  # persistent thread_id
     # agent = build_assistant()
     agent = get_agent()
@@ -327,10 +449,20 @@ if __name__ == "__main__":
         if user_input.lower() in ["exit", "quit"]:
             break
 
-        result = agent.invoke(
-            input={"messages": [HumanMessage(user_input)]},
-            config=config
-        )
-
-        pretty_print_messages(result["messages"])
+        # print answer tokens as they arrive instead of waiting for the whole turn,
+        # only chat model nodes are echoed so reranker output from inside the tool node stays hidden
+        async for chunk, metadata in agent.astream(
+                input={"messages": [HumanMessage(user_input)]},
+                config=config,
+                stream_mode="messages"
+        ):
+            if metadata.get("langgraph_node") in ANSWER_NODES and isinstance(chunk.content, str):
+                sys.stdout.write(chunk.content)
+                sys.stdout.flush()
+        # the answer was already streamed above, so the checkpointed history is not pretty-printed again
+        print()
         # time.sleep(0.2)  # small delay to make console easier to read
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
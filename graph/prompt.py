@@ -1,3 +1,4 @@
+import re
 from string import Template
 
 RETRIEVAL_PROMPT = Template("""
@@ -151,4 +152,22 @@ AGENT_ROUTER_PROMPT = """
 Classify the query rules
 1. tutors_modules: When the query is about tutors or modules
 2. normal: normal chatting, might be faq, policies, study plans, general queries. Might also includes individuals that are not tutors.
-"""
\ No newline at end of file
+"""
+
+
+# ============================================================================
+# PRECOMPILED RENDERERS
+# ============================================================================
+
+def _as_format_string(template: Template) -> str:
+    """Converts a `$name` Template into an equivalent `str.format` string so rendering skips the Template regex"""
+    escaped = template.template.replace("{", "{{").replace("}", "}}")
+    return re.sub(r"\$(\w+)", r"{\1}", escaped)
+
+
+_RERANK_FMT = _as_format_string(RERANK_PROMPT)
+
+
+def render_rerank_prompt(query: str, retrieved_data: str) -> str:
+    """Renders RERANK_PROMPT, repeated query/data pairs are already memoized by the reranker's own cache"""
+    return _RERANK_FMT.format(query=query, retrieved_data=retrieved_data)
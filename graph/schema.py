@@ -1,13 +1,36 @@
-from typing import List, Literal
+from collections import deque
+from typing import List, Literal, Annotated, Optional
 
 from langgraph.graph import MessagesState
 from pydantic import BaseModel, Field
 
 
+def extend_or_reset(current: Optional[List[int]], update: Optional[List[int]]) -> List[int]:
+    """Reducer that appends new items, or clears the list when the update is None"""
+    if update is None:
+        return []
+    return (current or []) + update
+
+
+# most recent retrieved chunks kept in state, older ones are dropped first
+RETRIEVAL_RESULT_CAP = 32
+
+
+def bounded_extend(current: Optional[List[str]], update: Optional[List[str]]) -> List[str]:
+    """Reducer that appends new items while keeping only the last RETRIEVAL_RESULT_CAP, or clears on None"""
+    if update is None:
+        return []
+    bounded = deque(current or [], maxlen=RETRIEVAL_RESULT_CAP)
+    bounded.extend(update)
+    return list(bounded)
+
+
 class AgentState(MessagesState):
     """Enhanced state that tracks retrieval results and iterations"""
-    # retrieval_result: List[str]
-    # query: str
+    retrieval_result: Annotated[List[str], bounded_extend]
+    query: str
+    # positions of the current turn's tool messages within `messages`, cleared by cleanup_state
+    tool_msg_indices: Annotated[List[int], extend_or_reset]
 
 
 class RouterSchema(BaseModel):
@@ -0,0 +1,77 @@
+import threading
+import time
+from typing import Any, Optional
+
+import numpy as np
+
+from data_prep.qdrant.config import embed_query
+
+
+def embed_text(text: str) -> np.ndarray:
+    """Embeds text into a normalized vector so cosine similarity is a plain dot product"""
+    # shares the memoized query embedding with retrieval, so a cached question is not embedded twice
+    vector = embed_query(text)
+    return vector / np.linalg.norm(vector)
+
+
+class SemanticCache:
+    """In-process cache returning a stored value when a new embedding is close enough to a cached one"""
+
+    def __init__(self, threshold: float = 0.95, max_size: int = 1024, ttl_seconds: Optional[float] = None):
+        """
+        Args:
+            threshold: minimum cosine similarity for a hit
+            max_size: number of entries kept, the least recently used is replaced first
+            ttl_seconds: age after which an entry no longer hits, None keeps entries until they are replaced
+        """
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # preallocated on the first put once the embedding size is known, the first _size rows are in use
+        self._vectors: Optional[np.ndarray] = None
+        self._size = 0
+        self._values: list[Any] = [None] * max_size
+        self._scopes = np.empty(max_size, dtype=object)
+        self._stored_at = np.zeros(max_size)
+        self._used_at = np.zeros(max_size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, vector: np.ndarray, scope: str = "") -> Optional[Any]:
+        """
+        Returns the value of the most similar cached entry, or None below the threshold.
+        Only unexpired entries stored under the same scope are considered.
+        """
+        with self._lock:
+            if self._size:
+                now = time.monotonic()
+                size = self._size
+                scores = self._vectors[:size] @ vector
+                excluded = self._scopes[:size] != scope
+                if self.ttl_seconds is not None:
+                    excluded |= now - self._stored_at[:size] > self.ttl_seconds
+                scores[excluded] = -np.inf
+                best = int(scores.argmax())
+                if scores[best] >= self.threshold:
+                    self._used_at[best] = now
+                    self.hits += 1
+                    return self._values[best]
+            self.misses += 1
+        return None
+
+    def put(self, vector: np.ndarray, value: Any, scope: str = "") -> None:
+        """Stores a value under its embedding and scope"""
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.empty((self.max_size, len(vector)), dtype=np.float32)
+            if self._size < self.max_size:
+                slot = self._size
+                self._size += 1
+            else:
+                # full, overwrite the least recently used slot in place
+                slot = int(np.argmin(self._used_at))
+            self._vectors[slot] = vector
+            self._values[slot] = value
+            self._scopes[slot] = scope
+            self._stored_at[slot] = self._used_at[slot] = time.monotonic()
@@ -1,9 +1,37 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Literal
 
 from ddgs import DDGS
 from langchain_core.tools import tool
 
-from data_prep.qdrant.config import query_all_collections
+from common.logger_config import get_logger
+from data_prep.qdrant.config import query_all_collections, rerank_documents
+
+if "streamlit" in sys.modules:
+    from graph.semantic_cache import SemanticCache, embed_text
+else:
+    from semantic_cache import SemanticCache, embed_text
+
+# fixed strings used when formatting tool output, built once instead of per call
+RETRIEVED_DOCUMENTS_HEADER = "=== Retrieved Documents ===\n"
+NO_DOCUMENTS_FOUND = "No relevant documents found."
+
+# repeated or paraphrased questions reuse the reranked documents without searching qdrant again, for ten minutes
+# so re-ingested data shows up
+retrieval_cache = SemanticCache(threshold=0.97, max_size=2000, ttl_seconds=600)
+
+logger = get_logger(__name__)
+
+
+def _search_site(query: str) -> list[dict[str, Any]] | None:
+    """Runs one DDG text search, a failing site returns None so the other site's results are still used"""
+    try:
+        with DDGS() as ddgs:
+            return ddgs.text(query, max_results=5) or []
+    except Exception as e:
+        logger.warning("Site search failed for %r: %s", query, e)
+        return None
 
 
 @tool
@@ -19,11 +47,21 @@ def searching_aou_site(query: str) -> list[dict[str, Any]] | str:
     try:
         query1 = f"{query} - site:https://www.arabou.edu.kw/"
         query2 = f"{query} - site:https://www.aou.edu.om/"
-        with DDGS() as ddgs:
-            results1 = ddgs.text(query1, max_results=5)
-            results2 = ddgs.text(query2, max_results=5)
-            results = results1 + results2
-            return results
+        # both sites are searched at the same time, each with its own DDGS session
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results1, results2 = executor.map(_search_site, [query1, query2])
+        if results1 is None and results2 is None:
+            # kept as an error string so cleanup_state does not cache an answer written without search results
+            return "Error using the searching tool: both site searches failed"
+        # both sites can return the same page, keep it once so it is not reranked twice
+        unique, seen = [], set()
+        for result in (results1 or []) + (results2 or []):
+            href = result.get("href")
+            # results without an href cannot be matched, so each of them is kept
+            if href is None or href not in seen:
+                seen.add(href)
+                unique.append(result)
+        return unique
     except Exception as e:
         return f"Error using the searching tool: {str(e)}"
 
@@ -40,13 +78,17 @@ def retrieve_aou_knowledge_base(query: str) -> str:
     """
 
     try:
-        results = query_all_collections(query)
+        query_vector = embed_text(query)
+        results = retrieval_cache.get(query_vector)
+        if results is None:
+            # drop low relevance chunks locally so they never reach the llm prompt
+            results = rerank_documents(query, query_all_collections(query))
+            retrieval_cache.put(query_vector, results)
         if not results:
-            return "No relevant documents found."
+            return NO_DOCUMENTS_FOUND
 
-        formatted = "=== Retrieved Documents ===\n"
-        formatted += "\n".join(results)
-        return formatted
+        # single join over the documents, no intermediate string rebuilt with +=
+        return RETRIEVED_DOCUMENTS_HEADER + "\n".join(results)
     except Exception as e:
         return f"Error retrieving documents: {str(e)}"
 
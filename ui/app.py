@@ -1,12 +1,14 @@
 import base64
 import time
+import uuid
 from pathlib import Path
 from string import Template
 
 import streamlit as st
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage
 from streamlit_theme import st_theme
-from graph.graph import build_assistant, get_agent
+from data_prep.qdrant import get_embedding_model, get_reranker_model
+from graph.graph import build_assistant, get_agent, ANSWER_NODES
 from ui.helpers.client import get_client_info
 from ui.helpers.query_logger import QueryLogger
 
@@ -15,14 +17,24 @@ from ui.helpers.query_logger import QueryLogger
 bot_icon_path = Path(__file__).parent / "assets" / "aou_bot_icon.png"
 user_icon_path = Path(__file__).parent / "assets" / "user_icon.png"
 bg_image_path = Path(__file__).parent / "assets" / "bg.jpg"
+# written by `python -m ui.helpers.build_assets`
+bg_base64_path = Path(__file__).parent / "assets" / "bg_b64.txt"
 # Initialize logger
 @st.cache_resource
 def get_logger():
     """Initialize query logger once"""
-    return QueryLogger()  # Reads from DATABASE_URL env variable
+    return QueryLogger.get()  # Reads from SUPABASE_* env variables
 
 logger = get_logger()
 
+@st.cache_resource
+def get_assistant():
+    """Load the embedding/reranker weights and build the agent once, shared across sessions and reruns"""
+    # loaded here rather than on the first query so no user waits for the weights
+    get_embedding_model()
+    get_reranker_model()
+    return get_agent()
+
 # have to set it initially
 def get_theme():
     try:
@@ -64,10 +76,15 @@ def get_base64_image(image_path):
     with open(image_path, "rb") as img_file:
         return base64.b64encode(img_file.read()).decode()
 
+@st.cache_resource
+def get_bg_base64():
+    """Prebuilt base64 of the background, the image is only encoded here when the sidecar was not built"""
+    if bg_base64_path.exists():
+        return bg_base64_path.read_text()
+    return get_base64_image(bg_image_path) if bg_image_path.exists() else ""
+
 # overriding styles/creating elements and making them adapt to ui theme change
-@st.cache_data
-def get_custom_styles(overlay_color, header_text_color, bg_image_base64):
-    return Template("""
+CUSTOM_STYLES_TEMPLATE = Template("""
 <style>
 
 [data-testid="stAppViewContainer"] {
@@ -125,22 +142,37 @@ def get_custom_styles(overlay_color, header_text_color, bg_image_base64):
         color: #007bff;
     }
 </style>
-""").substitute(overlay_color=overlay_color, header_text_color=header_text_color, bg_image=bg_image_base64)
+""")
 
+@st.cache_resource
+def get_custom_styles():
+    """Styles of both themes keyed by their colors, substituted once per process and shared by every rerun"""
+    bg_image_base64 = get_bg_base64()
+    styles = {}
+    for theme_name in ("light", "dark"):
+        overlay_color, header_text_color = get_theme_colors(theme_name)
+        styles[(overlay_color, header_text_color)] = CUSTOM_STYLES_TEMPLATE.substitute(
+            overlay_color=overlay_color, header_text_color=header_text_color, bg_image=bg_image_base64
+        )
+    return styles
 
-st.markdown(get_custom_styles(overlay_color, header_text_color, get_base64_image(bg_image_path) if bg_image_path.exists() else ""), unsafe_allow_html=True)
+
+st.markdown(get_custom_styles()[(overlay_color, header_text_color)], unsafe_allow_html=True)
 
 # session state init
 
 if "assistant" not in st.session_state:
     #st.session_state.assistant = build_assistant()
-    st.session_state.assistant = get_agent()
+    st.session_state.assistant = get_assistant()
 
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
+# bumped with every new prompt so the cached history of a thread is read again after it changes
+if "history_version" not in st.session_state:
+    st.session_state.history_version = 0
+
 if "thread_id" not in st.session_state:
-    import uuid
     st.session_state.thread_id = str(uuid.uuid4())
 
 with st.sidebar:
@@ -154,28 +186,31 @@ with st.sidebar:
 
     if st.button("Clear Conversation"):
         # create a new thread ID
-        import uuid
-
         st.session_state.thread_id = str(uuid.uuid4())
         st.rerun()
 
     st.caption(f"Thread ID: `{st.session_state.thread_id[:8]}...`")
 
-def get_conversation_history():
-    """Retrieve conversation history from LangGraph's checkpointer"""
+# message type tag -> chat role shown in the ui, one dict lookup per message instead of isinstance checks
+DISPLAY_ROLES = {"human": "user", "ai": "assistant"}
+
+@st.cache_data(ttl=30, show_spinner=False)
+def get_conversation_history(thread_id, version):
+    """Retrieve conversation history from LangGraph's checkpointer, cached per thread and history version"""
     try:
-        config = {"configurable": {"thread_id": st.session_state.thread_id}}
-        state = st.session_state.assistant.get_state(config)
+        config = {"configurable": {"thread_id": thread_id}}
+        state = get_assistant().get_state(config)
 
-        # extract only HumanMessage and AIMessage for display
+        # extract only human and ai messages for display
         messages = []
-        for msg in state.values.get("messages", []):
-            if isinstance(msg, HumanMessage):
-                messages.append({"role": "user", "content": msg.content})
-            elif isinstance(msg, AIMessage) and msg.content:
-                # skip tool calls and empty messages, so we do not populate the token
-                if not hasattr(msg, 'tool_calls') or not msg.tool_calls:
-                    messages.append({"role": "assistant", "content": msg.content})
+        for msg in state.values.get("messages", ()):
+            role = DISPLAY_ROLES.get(msg.type)
+            if role is None:
+                continue
+            # skip tool calls and empty messages, so we do not populate the token
+            if role == "assistant" and (not msg.content or getattr(msg, "tool_calls", None)):
+                continue
+            messages.append({"role": role, "content": msg.content})
 
         return messages
     except Exception as e:
@@ -191,40 +226,40 @@ async def query_assistant(prompt):
         human_message = {"messages": [HumanMessage(content=prompt)]}
         config = {"configurable": {"thread_id": st.session_state.thread_id}}
 
-        async for event in st.session_state.assistant.astream_events(
+        # answer tokens come from the messages stream, finished nodes (tool calls requested, tool results) from updates
+        async for mode, payload in st.session_state.assistant.astream(
                 human_message,
                 config=config,
-                version="v1"
+                stream_mode=["messages", "updates"]
         ):
-            event_type = event["event"]
-
-            # detect when a tool is about to be called
-            if event_type == "on_tool_start":
-                tool_name = event["name"]
-                tool_input = event["data"].get("input", {})
-
-                # status card for the tool
-                with st.status(f"🟢 Running **{tool_name}**...", expanded=True) as _:
-                    st.markdown(f"`{tool_input}`")
-
-            elif event_type == "on_tool_end":
-                tool_name = event["name"]
-                full_response += f"\nUsed tool: {tool_name}\n"
-                output_data = event["data"].get("output", "No output returned")
-
-                # just for debugging
-                if debugging := False:
-                    with st.status(f"✅ **{tool_name}** completed", expanded=True) as status:
-                        st.markdown("**Response:**")
-                        st.code(str(output_data), language="json")
-                        status.update(label=f"Tool `{tool_name}` finished", state="complete")
-
-            # stream the actual content tokens
-            elif event_type == "on_chat_model_stream":
-                chunk = event["data"].get("chunk")
-                if chunk and hasattr(chunk, "content") and chunk.content:
+            if mode == "messages":
+                chunk, metadata = payload
+                # stream the actual content tokens, the reranker's structured output inside tools is not part of them
+                if metadata.get("langgraph_node") in ANSWER_NODES and isinstance(chunk.content, str) and chunk.content:
                     full_response += chunk.content
                     yield chunk.content
+                continue
+
+            for update in payload.values():
+                if not isinstance(update, dict):
+                    continue
+                for msg in update.get("messages", []):
+                    # the model asked for tools, they are about to run
+                    if msg.type == "ai" and msg.tool_calls:
+                        for tool_call in msg.tool_calls:
+                            # status card for the tool
+                            with st.status(f"🟢 Running **{tool_call['name']}**...", expanded=True) as _:
+                                st.markdown(f"`{tool_call['args']}`")
+
+                    elif msg.type == "tool":
+                        full_response += f"\nUsed tool: {msg.name}\n"
+
+                        # just for debugging
+                        if debugging := False:
+                            with st.status(f"✅ **{msg.name}** completed", expanded=True) as status:
+                                st.markdown("**Response:**")
+                                st.code(str(msg.content), language="json")
+                                status.update(label=f"Tool `{msg.name}` finished", state="complete")
     except Exception as e:
         error_msg = str(e)
         print(f"Error in query_assistant: {e}")
@@ -241,7 +276,7 @@ async def query_assistant(prompt):
 
 # only fetch history if messages cache is empty
 if not st.session_state.messages:
-    st.session_state.messages = get_conversation_history()
+    st.session_state.messages = get_conversation_history(st.session_state.thread_id, st.session_state.history_version)
 
 # display chat messages from LangGraph's memory
 for message in st.session_state.messages:
@@ -282,6 +317,7 @@ if prompt:
 
     # adding user message to history
     st.session_state.messages.append({"role": "user", "content": prompt})
+    st.session_state.history_version += 1
 
     # display user message
     with st.chat_message("user", avatar=user_icon_path):
@@ -0,0 +1,17 @@
+import base64
+from pathlib import Path
+
+assets_dir = Path(__file__).parent.parent / "assets"
+bg_image_path = assets_dir / "bg.jpg"
+bg_base64_path = assets_dir / "bg_b64.txt"
+
+
+def build_bg_base64(image_path=bg_image_path, output_path=bg_base64_path):
+    """Write the base64 of the background image next to it, so the app reads it instead of encoding it"""
+    output_path.write_text(base64.b64encode(image_path.read_bytes()).decode())
+    return output_path
+
+
+if __name__ == "__main__":
+    # python -m ui.helpers.build_assets
+    print(f"Wrote {build_bg_base64()}")
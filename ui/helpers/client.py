@@ -2,12 +2,15 @@ from streamlit.web.server.websocket_headers import _get_websocket_headers
 import streamlit as st
 
 def get_client_info():
-    """Extract IP address and user agent from Streamlit headers"""
+    """Extract IP address and user agent from Streamlit headers, read once per session"""
+    if "_client_info" in st.session_state:
+        return st.session_state._client_info
     try:
         headers = st.context.headers
         ip_address = headers.get("X-Forwarded-For", headers.get("Remote-Addr"))
         user_agent = headers.get("User-Agent")
-        return ip_address, user_agent
+        st.session_state._client_info = (ip_address, user_agent)
+        return st.session_state._client_info
     except:
         return None, None
 
@@ -1,26 +1,140 @@
+import asyncio
+import atexit
+import functools
+import gzip
 import os
-from typing import Optional
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import ClassVar, Optional
+from urllib.request import getproxies
 
+import httpx
+import orjson
 import supabase
 from dotenv import load_dotenv
+from supabase import ClientOptions
+from psycopg2 import InterfaceError, OperationalError, sql
+from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+from common.logger_config import get_logger
+
+
+logger = get_logger(__name__)
+
+
+@functools.lru_cache(maxsize=1)
+def _env():
+    """Reads the .env file once per process and returns the settings the logger needs"""
+    load_dotenv()
+    return os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"), os.getenv("SUPABASE_CONNECTION_STRING")
 
 
 class QueryLogger:
     """Async-safe logger for user queries"""
     TABLE_NAME = "query_logs"
+    # postgrest paths and headers of the flush requests, built once instead of per write
+    TABLE_PATH = f"/{TABLE_NAME}"
+    BATCH_RPC_PATH = "/rpc/log_batch"
+    UPSERT_HEADERS = {"Content-Type": "application/json", "Prefer": "resolution=merge-duplicates,return=minimal"}
+    RPC_HEADERS = {"Content-Type": "application/json", "Prefer": "return=minimal"}
+    _instance: ClassVar[Optional["QueryLogger"]] = None
+    _instance_lock: ClassVar[threading.Lock] = threading.Lock()
+    # pending updates kept before the oldest is dropped, the request path never waits on a full queue
+    MAX_PENDING = 10_000
+    # longest a drained update waits for others to join its flush
+    FLUSH_INTERVAL = float(os.getenv("QUERY_LOG_FLUSH_INTERVAL", "0.1"))
+    # AOUNET_LOG_UNBUFFERED=1 writes every update before log_query returns, e.g. while debugging; buffered updates
+    # can be lost on a crash, up to FLUSH_INTERVAL worth of them
+    BUFFERED = os.getenv("AOUNET_LOG_UNBUFFERED") != "1"
+    # longest shutdown waits for pending updates, so a flush stuck on the network cannot hang the process
+    EXIT_FLUSH_TIMEOUT = 5
+    # most updates written by one flush
+    MERGE_BATCH_LIMIT = 100
+    # rough cap on the text sent by one upsert request, keeps large responses under the request size limit
+    MAX_BATCH_BYTES = 1_000_000
+    # with QUERY_LOG_DIRECT_PG=1 and SUPABASE_CONNECTION_STRING set, flushes skip the https api and write over pooled
+    # postgres connections; psycopg2 never creates server-side prepared statements, so supabase's transaction pooler
+    # (port 6543) works, though the session pooler (port 5432) suits these long-lived connections better
+    DIRECT_POSTGRES = os.getenv("QUERY_LOG_DIRECT_PG") == "1"
+    # connections held for the flush thread when writing straight to postgres, a few per process keeps every
+    # streamlit worker well inside supabase's connection cap
+    POOL_MIN_CONNECTIONS = int(os.getenv("QUERY_LOG_POOL_MIN", "1"))
+    POOL_MAX_CONNECTIONS = int(os.getenv("QUERY_LOG_POOL_MAX", "2"))
+    # seconds after which a pooled connection is closed and reopened instead of reused
+    POOL_RECYCLE = 1800
+    # idle https connections to the api kept open between flushes, so a flush seconds after the last one skips the
+    # tcp/tls handshake (httpx's default expiry is 5s)
+    HTTP_LIMITS = httpx.Limits(max_keepalive_connections=5, max_connections=15, keepalive_expiry=30)
+    # an update identical to one queued within DEDUP_TTL seconds is dropped, the last DEDUP_SIZE are remembered
+    DEDUP_TTL = 30
+    DEDUP_SIZE = 1024
+    # flush bodies above GZIP_MIN_BYTES are gzip-compressed (level 1) when QUERY_LOG_GZIP=1, opt-in because the
+    # gateway in front of postgrest has to accept Content-Encoding: gzip request bodies
+    GZIP_REQUESTS = os.getenv("QUERY_LOG_GZIP") == "1"
+    GZIP_MIN_BYTES = 1024
+    # with QUERY_LOG_BATCH_RPC=1 a flush goes through the log_batch function (data_prep/sql_scripts/log_batch.sql),
+    # one request and one transaction for the whole batch instead of one upsert per column set
+    BATCH_RPC = os.getenv("QUERY_LOG_BATCH_RPC") == "1"
 
     def __init__(self):
         """
         Initialize logger with Supabase PostgreSQL client
         Args:
         """
-        load_dotenv()
-        self.url = os.getenv("SUPABASE_URL")
-        self.key = os.getenv("SUPABASE_KEY")
+        self.url, self.key, self.db_url = _env()
         if not self.url or not self.key:
             raise ValueError("supabase url and key are required")
 
-        self.client = supabase.create_client(self.url, self.key)
+        self.client = self._create_client()
+
+        # the pool connects on first use from the flush thread, so constructing the logger makes no network call
+        self.use_postgres = self.DIRECT_POSTGRES and bool(self.db_url)
+        self.pool = None
+        self._pool_lock = threading.Lock()
+        self._connection_opened_at = {}
+
+        # runs log_query for async callers, so the synchronous insert never blocks their event loop
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="query-logger-call")
+        self._recent_updates = OrderedDict()
+        self._recent_lock = threading.Lock()
+
+        # updates of existing rows are written by a background thread, off the request path
+        self._queue = queue.Queue(maxsize=self.MAX_PENDING)
+        threading.Thread(target=self._drain, name="query-logger", daemon=True).start()
+        atexit.register(self.flush, timeout=self.EXIT_FLUSH_TIMEOUT)
+
+    @classmethod
+    def get(cls) -> "QueryLogger":
+        """Process-wide logger, every caller shares one client, connection pool and flush thread"""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def _create_client(self):
+        """
+        Creates the supabase client with an http client using HTTP_LIMITS and retrying failed connects.
+        It is handed over through ClientOptions so supabase sets the urls and headers and reuses it whenever the
+        postgrest client is rebuilt; supabase releases without the httpx_client option keep their default client.
+        """
+        options = ClientOptions()
+        if not hasattr(options, "httpx_client"):
+            return supabase.create_client(self.url, self.key)
+        options.httpx_client = httpx.Client(
+            # the settings supabase's own postgrest session uses, a custom transport skips httpx's env proxy lookup
+            # so the proxy is read here
+            timeout=options.postgrest_client_timeout,
+            follow_redirects=True,
+            transport=httpx.HTTPTransport(
+                retries=2, limits=self.HTTP_LIMITS, http2=True, proxy=getproxies().get("https")
+            ),
+        )
+        return supabase.create_client(self.url, self.key, options)
 
     def log_query(
             self,
@@ -31,16 +145,235 @@ class QueryLogger:
             error_message: Optional[str] = None,
             response: Optional[str] = None,
     ):
-        payload = {
-            k: v for k, v in {
-                "id": id,
-                "query_text": query_text,
-                "ip_address": ip_address,
-                "user_agent": user_agent,
-                "error_message": error_message,
-                "response": response
-            }.items() if v is not None}
-
-        return self.client.table(self.TABLE_NAME).upsert(
-            payload
-        ).execute()
+        """
+        Inserts a new log row and returns the upsert response, the caller reads the generated id from it.
+        Updates of an existing row (id given) are queued and written in the background, returning None.
+        """
+        # only the given fields are sent, built directly instead of filtering a temporary dict of all six
+        payload = {}
+        if id is not None:
+            payload["id"] = id
+        if query_text is not None:
+            payload["query_text"] = query_text
+        if ip_address is not None:
+            payload["ip_address"] = ip_address
+        if user_agent is not None:
+            payload["user_agent"] = user_agent
+        if error_message is not None:
+            payload["error_message"] = error_message
+        if response is not None:
+            payload["response"] = response
+
+        # nothing to write besides the id, skip the round trip
+        if not payload.keys() - {"id"}:
+            return None
+
+        if id is None:
+            return self.client.table(self.TABLE_NAME).upsert(
+                payload
+            ).execute()
+
+        if self._is_duplicate(payload):
+            return None
+        if self.BUFFERED:
+            self._enqueue(payload)
+        else:
+            self._write_rows([payload])
+        return None
+
+    def _is_duplicate(self, payload):
+        """Whether the same update was queued within DEDUP_TTL, records it otherwise"""
+        key = frozenset(payload.items())
+        now = time.monotonic()
+        with self._recent_lock:
+            queued_at = self._recent_updates.get(key)
+            if queued_at is not None and now - queued_at < self.DEDUP_TTL:
+                return True
+            self._recent_updates[key] = now
+            self._recent_updates.move_to_end(key)
+            if len(self._recent_updates) > self.DEDUP_SIZE:
+                self._recent_updates.popitem(last=False)
+        return False
+
+    async def log_query_async(self, **kwargs):
+        """
+        log_query for async code, run on the logger's thread pool.
+        Fire and forget with asyncio.create_task(logger.log_query_async(...)) when the result is not needed.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(self.log_query, **kwargs)
+        )
+
+    def flush(self, timeout: Optional[float] = None):
+        """Blocks until every queued update has been written, or until timeout seconds have passed"""
+        if timeout is None:
+            self._queue.join()
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _enqueue(self, payload):
+        while True:
+            try:
+                self._queue.put_nowait(payload)
+                return
+            except queue.Full:
+                # drop the oldest pending update instead of blocking the caller
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                except queue.Empty:
+                    pass
+
+    @staticmethod
+    def _payload_size(payload):
+        """Rough size of the text a payload sends"""
+        return sum(len(str(value)) for value in payload.values())
+
+    def _next_batch(self):
+        """
+        Collects queued updates until FLUSH_INTERVAL passes, MERGE_BATCH_LIMIT or MAX_BATCH_BYTES is reached,
+        or an error arrives, errors are flushed right away so they reach the table promptly
+        """
+        batch = [self._queue.get()]
+        size = self._payload_size(batch[0])
+        deadline = time.monotonic() + self.FLUSH_INTERVAL
+        while len(batch) < self.MERGE_BATCH_LIMIT and size < self.MAX_BATCH_BYTES and "error_message" not in batch[-1]:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+            size += self._payload_size(batch[-1])
+        return batch
+
+    @staticmethod
+    def _merge(batch):
+        """Folds updates of the same row into one and groups rows by their columns, a bulk upsert needs matching keys"""
+        rows = {}
+        for payload in batch:
+            rows.setdefault(payload["id"], {}).update(payload)
+
+        # rows go out in primary key order, each upsert walks the id index in one direction and concurrent
+        # flushes lock rows in the same order
+        groups = {}
+        for _, row in sorted(rows.items()):
+            groups.setdefault(frozenset(row), []).append(row)
+        return groups.values()
+
+    def _split(self, rows):
+        """Splits rows into upserts that each stay under MAX_BATCH_BYTES"""
+        chunk, size = [], 0
+        for row in rows:
+            row_size = self._payload_size(row)
+            if chunk and size + row_size > self.MAX_BATCH_BYTES:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(row)
+            size += row_size
+        if chunk:
+            yield chunk
+
+    def _write_rows(self, rows):
+        """Upserts rows sharing the same columns, in one statement over a pooled connection when one is configured"""
+        if not self.use_postgres or self._get_pool() is None:
+            # posted through the postgrest session directly so the body is encoded by orjson (C, straight to bytes)
+            # rather than stdlib json, the response body is not needed
+            self._post(self.TABLE_PATH, rows, self.UPSERT_HEADERS)
+            return
+
+        columns = list(rows[0])
+        updates = [
+            sql.SQL("{column} = EXCLUDED.{column}").format(column=sql.Identifier(column))
+            for column in columns if column != "id"
+        ]
+        statement = sql.SQL("INSERT INTO {table} ({columns}) VALUES %s ON CONFLICT (id) DO {action}").format(
+            table=sql.Identifier(self.TABLE_NAME),
+            columns=sql.SQL(", ").join(map(sql.Identifier, columns)),
+            action=sql.SQL("UPDATE SET {}").format(sql.SQL(", ").join(updates)) if updates else sql.SQL("NOTHING"),
+        )
+        values = [[row[column] for column in columns] for row in rows]
+        for attempt in range(2):
+            try:
+                conn = self._acquire()
+            except PoolError:
+                # getconn does not wait, with AOUNET_LOG_UNBUFFERED=1 every session thread writes and can find the
+                # pool empty, those writes go through the api instead of failing the caller
+                self._post(self.TABLE_PATH, rows, self.UPSERT_HEADERS)
+                return
+            broken = False
+            try:
+                with conn, conn.cursor() as cur:
+                    # the commit returns without waiting for the wal flush, a crash can lose at most the last few
+                    # hundred ms of log updates but never corrupts the table
+                    cur.execute("SET LOCAL synchronous_commit TO OFF")
+                    execute_values(cur, statement, values)
+                return
+            except (OperationalError, InterfaceError):
+                # the server or pooler dropped the connection, retry once on a fresh one
+                broken = True
+                if attempt:
+                    raise
+            finally:
+                # every other error (bad data, constraint violations) still hands the connection back
+                self._release(conn, close=broken)
+
+    def _post(self, path, data, headers):
+        """Posts data to postgrest, encoded by orjson (C, straight to bytes) rather than stdlib json"""
+        body = orjson.dumps(data)
+        if self.GZIP_REQUESTS and len(body) > self.GZIP_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=1)
+            headers = {**headers, "Content-Encoding": "gzip"}
+        self.client.postgrest.session.post(path, content=body, headers=headers).raise_for_status()
+
+    def _get_pool(self):
+        """Creates the connection pool on first use, a failed connect is logged and retried on the next write"""
+        if self.pool is None:
+            with self._pool_lock:
+                if self.pool is None:
+                    try:
+                        self.pool = ThreadedConnectionPool(
+                            self.POOL_MIN_CONNECTIONS, self.POOL_MAX_CONNECTIONS, self.db_url
+                        )
+                    except Exception as e:
+                        logger.warning("Could not connect to postgres for query logs, using the api: %s", e)
+        return self.pool
+
+    def _acquire(self):
+        """Takes a pooled connection, reopening it when it was closed or is older than POOL_RECYCLE"""
+        conn = self.pool.getconn()
+        opened_at = self._connection_opened_at.get(conn)
+        if conn.closed or (opened_at is not None and time.monotonic() - opened_at > self.POOL_RECYCLE):
+            self._release(conn, close=True)
+            conn = self.pool.getconn()
+        self._connection_opened_at.setdefault(conn, time.monotonic())
+        return conn
+
+    def _release(self, conn, close=False):
+        if close:
+            self._connection_opened_at.pop(conn, None)
+        self.pool.putconn(conn, close=close)
+
+    def _drain(self):
+        while True:
+            batch = self._next_batch()
+            groups = self._merge(batch)
+            use_rpc = self.BATCH_RPC and not self.use_postgres
+            if use_rpc:
+                # the function takes rows with any mix of columns, so every group goes in the same call
+                groups = [[row for rows in groups for row in rows]]
+            # one multi-row write per column set instead of a round trip per update
+            for rows in groups:
+                for chunk in self._split(rows):
+                    try:
+                        if use_rpc:
+                            self._post(self.BATCH_RPC_PATH, {"payloads": chunk}, self.RPC_HEADERS)
+                        else:
+                            self._write_rows(chunk)
+                    except Exception:
+                        logger.exception("Error writing query logs")
+            for _ in batch:
+                self._queue.task_done()
@@ -1,7 +1,7 @@
 from query_logger import QueryLogger
 from ui.helpers.client import get_client_info
 
-logger = QueryLogger()
+logger = QueryLogger.get()
 
 # Get client info
 ip_address, user_agent = "192.168.1.10", "me"